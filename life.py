@@ -1,132 +1,162 @@
 #! /usr/bin/env python3
 
 from enum import Enum, auto
-import threading
 import time
 import tkinter as tk
 
+import numpy as np
+
 
 WIDTH, HEIGHT = 501, 301
 
+# How often the generation counter is redrawn, in milliseconds.
+LABEL_REFRESH_INTERVAL = 100
+
+# Upper bound on the memory World spends memoizing generations, in bytes.
+MEMO_BYTES = 2**24
+
 
 class Status(Enum):
     PAUSED = auto()
     PLAYING = auto()
 
-class Cell(Enum):
-    ALIVE = auto()
-    DEAD = auto()
+# Cell states, as stored in World.cells.
+DEAD, ALIVE = 0, 1
 
-CELL_COLOR = {Cell.ALIVE: 'black',
-              Cell.DEAD: 'white'}
+# Indexed by cell state.
+CELL_COLOR = ('white', 'black')
 
 
 class Stepper():
-    """Run a specified function at regular time intervals.
+    """Run a specified function at regular time intervals, from the Tk event
+    loop of a given widget.
 
     Begins in a paused state.
     """
 
-    def __init__(self, interval=1, callback=None, *args, **kwargs):
-        """Interval is in seconds. The callback does not need to be
-        thread-safe. Optionally, args and kwargs are passed to the callback
-        each time it is called."""
+    def __init__(self, widget, interval=1, callback=None, *args, **kwargs):
+        """Interval is in seconds. The callback runs on the Tk main loop, so it
+        may update widgets directly. Optionally, args and kwargs are passed to
+        the callback each time it is called."""
         self.callback = callback
         self.args = args
         self.kwargs = kwargs
         self.running = False
+        self._widget = widget
         self._interval = interval
-        self._control_lock = threading.Lock()
-        self._cb_lock = threading.Lock()
-        self._timer = None
+        self._after_id = None
 
     def start(self):
         """Begin running the function at regular intervals."""
-        with self._control_lock:
-            if not self.running:
-                self.running = True
-                self._run()
+        if not self.running:
+            self.running = True
+            self._run()
 
     def stop(self):
         """Pause execution of the function."""
-        with self._control_lock:
-            self._stop()
+        self.running = False
+        if self._after_id is not None:
+            self._widget.after_cancel(self._after_id)
+            self._after_id = None
 
     def set_interval(self, interval):
         """Set the interval between steps, in seconds."""
-        with self._control_lock:
-            if self.running and self._interval > 0.5:
-                # Be responsive: Begin anew immediately (don't finish old
-                # interval.)
-                self._stop()
-                self._interval = interval
-                self.running = True
-                self._run()
-            else:
-                self._interval = interval
-
-    def _stop(self):
-        self.running = False
-        if self._timer:
-            self._timer.cancel()
+        if self.running and self._interval > 0.5:
+            # Be responsive: Begin anew immediately (don't finish old
+            # interval.)
+            self.stop()
+            self._interval = interval
+            self.start()
+        else:
+            self._interval = interval
 
     def _run(self):
         # TODO Make the timing more accurate when interval is short, but still
         # never run the callback until the previous call has returned.
-        with self._cb_lock:
-            self.callback(*self.args, **self.kwargs)
-        self._run_again()
-
-    def _run_again(self):
+        self._after_id = None
+        self.callback(*self.args, **self.kwargs)
         if self.running:
-            self._timer = threading.Timer(self._interval, self._run)
-            self._timer.start()
+            self._after_id = self._widget.after(int(self._interval * 1000),
+                                                self._run)
 
 
 class World():
     def __init__(self, width, height):
         self.width = width
         self.height = height
-        self.cells = self._fresh_cells()
-        self.cells_changed = self._fresh_cells(state=True)
+        # One byte per cell, indexed [y, x]. Each board is the interior of a
+        # buffer with a one-cell ghost border, which is filled with the
+        # opposite edges before stepping so that neighbors wrap around the
+        # torus without any index arithmetic.
+        self._padded = np.zeros((height + 2, width + 2), dtype=np.uint8)
+        self._next_padded = np.zeros_like(self._padded)
+        self.cells = self._padded[1:-1, 1:-1]
+        self._next_cells = self._next_padded[1:-1, 1:-1]
+        self.cells_changed = np.ones((self.height, self.width), dtype=np.uint8)
+        # Whether the last generation changed nothing, in which case no later
+        # generation will either (until a cell is flipped).
+        self._settled = False
+        # Successor of each recently seen board, keyed and valued by the raw
+        # bytes of the board, so that periodic patterns (oscillators, or
+        # gliders on the torus) are replayed rather than recomputed.
+        self._successors = {}
+        self._max_successors = max(1, MEMO_BYTES // (2 * self.cells.nbytes))
+        self._row_sums = np.empty((height + 2, width), dtype=np.uint8)
+        self._neighbors = np.empty((height, width), dtype=np.uint8)
 
     def flip_cell(self, x, y):
-        if self.cells[y][x] == Cell.ALIVE:
-            self.cells[y][x] = Cell.DEAD
-        else:
-            self.cells[y][x] = Cell.ALIVE
-        self.cells_changed = self._fresh_cells(state=False)
-        self.cells_changed[y][x] = True
+        self.cells[y, x] ^= ALIVE
+        self._settled = False
+        self.cells_changed.fill(0)
+        self.cells_changed[y, x] = 1
 
     def step(self):
-        next_cells = self._fresh_cells()
-        next_cells_changed = self._fresh_cells(state=False)
-        for x in range(0, self.width):
-            for y in range(0, self.height):
-                neighbors = [((x-1) % self.width, (y-1) % self.height),
-                             ((x+0) % self.width, (y-1) % self.height),
-                             ((x+1) % self.width, (y-1) % self.height),
-                             ((x-1) % self.width, (y+0) % self.height),
-                             ((x+1) % self.width, (y+0) % self.height),
-                             ((x-1) % self.width, (y+1) % self.height),
-                             ((x+0) % self.width, (y+1) % self.height),
-                             ((x+1) % self.width, (y+1) % self.height)]
-                living_neighbors = [self.cells[y][x] for x, y in neighbors].count(Cell.ALIVE)
-                if living_neighbors == 3:
-                    next_cells[y][x] = Cell.ALIVE
-                elif living_neighbors == 2:
-                    next_cells[y][x] = self.cells[y][x]
-                next_cells_changed[y][x] = (self.cells[y][x] != next_cells[y][x])
-        self.cells_changed = next_cells_changed
-        self.cells = next_cells
-
-    def _fresh_cells(self, state=Cell.DEAD):
-        return [[Cell.DEAD for x in range(0, self.width)]
-                for y in range(0, self.height)]
+        if self._settled:
+            # cells_changed is already all False.
+            return
+        cells, next_cells = self.cells, self._next_cells
+        key = cells.tobytes()
+        successor = self._successors.get(key)
+        if successor is not None:
+            np.copyto(next_cells, np.frombuffer(successor, dtype=np.uint8)
+                      .reshape(cells.shape))
+        else:
+            self._next_generation(self._padded, next_cells)
+            if len(self._successors) >= self._max_successors:
+                self._successors.clear()
+            self._successors[key] = next_cells.tobytes()
+        # Both boards hold only 0 and 1, so XOR marks exactly the changes.
+        np.bitwise_xor(next_cells, cells, out=self.cells_changed)
+        self.cells, self._next_cells = next_cells, cells
+        self._padded, self._next_padded = self._next_padded, self._padded
+        self._settled = not self.cells_changed.any()
+
+    def _next_generation(self, padded, out):
+        # Wrap the opposite edges into the ghost border: rows first, then
+        # columns, which also fills in the corners.
+        padded[0] = padded[-2]
+        padded[-1] = padded[1]
+        padded[:, 0] = padded[:, -2]
+        padded[:, -1] = padded[:, 1]
+        # Sum each 3x3 block separably, first along rows and then along
+        # columns, as stride-1 offset slices into reused scratch buffers.
+        row_sums, neighbors = self._row_sums, self._neighbors
+        np.add(padded[:, :-2], padded[:, 1:-1], out=row_sums)
+        row_sums += padded[:, 2:]
+        np.add(row_sums[:-2], row_sums[1:-1], out=neighbors)
+        neighbors += row_sums[2:]
+        cells = padded[1:-1, 1:-1]
+        neighbors -= cells
+        # B3/S23 in one bitwise test: a cell is alive next generation iff
+        # (neighbors | self) == 3, i.e. 3 neighbors, or 2 neighbors and alive.
+        neighbors |= cells
+        np.equal(neighbors, 3, out=out)
 
 
 class Grid(tk.Canvas):
-    def __init__(self, *args, height=HEIGHT, width=WIDTH, cell_height=10, cell_width=10, **kwargs):
+    def __init__(self, *args, height=HEIGHT, width=WIDTH, cell_height=10, cell_width=10,
+                 cell_colors=CELL_COLOR, **kwargs):
+        """cell_colors is a sequence of Tk colors, indexed by cell state."""
         kwargs.setdefault('height', height)
         kwargs.setdefault('width', width)
         self.grid_size = (int((width-1) / cell_width),
@@ -136,25 +166,55 @@ class Grid(tk.Canvas):
         self.cell_width = cell_width
         self.cell_height = cell_height
         super().__init__(*args, **kwargs)
+        # Cells are rendered into an RGB framebuffer, which is blitted into a
+        # single image as PPM data. The framebuffer starts at the top-left grid
+        # line; the grid lines are drawn into it once and never overwritten.
+        self._palette = np.array([self._rgb(color) for color in cell_colors],
+                                 dtype=np.uint8)
+        grid_width, grid_height = self.grid_size
+        self._pixels = np.empty((grid_height * cell_height + 1,
+                                 grid_width * cell_width + 1, 3), dtype=np.uint8)
+        # The framebuffer viewed as one cell_height x cell_width block per cell,
+        # each with its right and bottom grid lines in the last column and row.
+        blocks = self._pixels[1:, 1:].reshape(grid_height, cell_height,
+                                              grid_width, cell_width, 3)
+        self._interiors = blocks[:, :-1, :, :-1]
+        self.photo = tk.PhotoImage(width=self.usable_width + 1,
+                                   height=self.usable_height + 1)
+        self.create_image(0, 0, image=self.photo, anchor=tk.NW)
         self.draw_grid()
 
     def draw_grid(self):
-        for y in range(1, self.usable_height + 1, self.cell_height):
-            self.create_line(1, y, self.usable_width+1, y, fill='#CCC')
-        for x in range(1, self.usable_width + 1, self.cell_width):
-            self.create_line(x, 1, x, self.usable_height+1, fill='#CCC')
-
-    def fill_cell(self, x, y, color='black'):
-        """The minimum value for x and y is 0. The maximum can be obtained
-        from grid_size (a 2-tuple)."""
-        if (not (0 <= x < self.grid_size[0]) or
-            not (0 <= y < self.grid_size[1])):
-            raise ValueError()
-        left = x * self.cell_width + 2
-        top = y * self.cell_height + 2
-        right = left + self.cell_width - 1
-        bottom = top + self.cell_height - 1
-        self.create_rectangle(left, top, right, bottom, fill=color, outline='')
+        self._pixels[...] = self._rgb('#CCC')
+
+    def draw_cells(self, cells, changed=None):
+        """Paint the cells. cells is an array of cell states, indexed [y, x],
+        whose shape is grid_size reversed. If changed, an array of the same
+        shape, is given, only the bounding box of its nonzero entries is
+        repainted."""
+        if changed is None:
+            top, left = 0, 0
+            bottom, right = cells.shape
+        else:
+            changed_coords = np.argwhere(changed)
+            if not len(changed_coords):
+                return
+            top, left = changed_coords.min(axis=0).tolist()
+            bottom, right = (changed_coords.max(axis=0) + 1).tolist()
+        self._interiors[top:bottom, :, left:right] = (
+            self._palette[cells[top:bottom, left:right]]
+            [:, np.newaxis, :, np.newaxis])
+        # The framebuffer region of those cells, with the grid lines around
+        # them.
+        y0, y1 = top * self.cell_height, bottom * self.cell_height + 1
+        x0, x1 = left * self.cell_width, right * self.cell_width + 1
+        header = 'P6 {} {} 255\n'.format(x1 - x0, y1 - y0).encode()
+        self.tk.call(self.photo.name, 'put',
+                     header + self._pixels[y0:y1, x0:x1].tobytes(),
+                     '-format', 'ppm', '-to', x0 + 1, y0 + 1)
+
+    def _rgb(self, color):
+        return [c >> 8 for c in self.winfo_rgb(color)]
 
     def get_cell_coords_at(self, x, y):
         coord_x = (x-1) // self.cell_width
@@ -173,8 +233,10 @@ class MainFrame(tk.Frame):
         self.create_widgets()
         self.world = World(*self.grid.grid_size)
         self._paint_world()
-        self.stepper = Stepper(callback=self.step)
+        self.stepper = Stepper(self, callback=self.step)
         self.set_speed(self.speed_slider.get())
+        self._shown_generation = self.generation
+        self._refresh_labels()
 
     def create_widgets(self):
         self.toolbar = tk.Frame(self)
@@ -212,21 +274,24 @@ class MainFrame(tk.Frame):
         self.generation += 1
         self.world.step()
         self._paint_world()
-        self.generation_lbl['text'] = str(self.generation)
 
     def clear(self):
         self.pause()
         self.generation = 0
         self.world = World(*self.grid.grid_size)
         self._paint_world()
-        self.generation_lbl['text'] = str(self.generation)
+
+    def _refresh_labels(self):
+        # Stepping only updates self.generation; the label is redrawn here, at
+        # a bounded rate, however fast the generations go by.
+        if self.generation != self._shown_generation:
+            self.generation_lbl['text'] = str(self.generation)
+            self._shown_generation = self.generation
+        self._refresh_id = self.after(LABEL_REFRESH_INTERVAL,
+                                      self._refresh_labels)
 
     def _paint_world(self):
-        width, height = self.grid.grid_size
-        for x in range(0, width):
-            for y in range(0, height):
-                if self.world.cells_changed[y][x]:
-                    self.grid.fill_cell(x, y, CELL_COLOR[self.world.cells[y][x]])
+        self.grid.draw_cells(self.world.cells, self.world.cells_changed)
 
     def play_pause(self):
         if self.status == Status.PAUSED:
@@ -257,8 +322,8 @@ class MainFrame(tk.Frame):
         self.stepper.set_interval(interval)
 
     def on_delete(self):
-        # TODO Fix bug: Why does the thread not always join?
         self.stepper.stop()
+        self.after_cancel(self._refresh_id)
         root.destroy()
 
 